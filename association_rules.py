@@ -0,0 +1,230 @@
+import json
+import logging
+import os
+from itertools import combinations
+
+from find_frequent_itemsets import apriori
+
+# Thiết lập logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# File chỉ mục luật kết hợp (được tạo offline bởi script này)
+RULES_INDEX_PATH = os.getenv("RULES_INDEX_PATH", "data/association_rules.json")
+
+# Ngưỡng mặc định khi khai phá luật
+MIN_SUPPORT = 0.005
+MIN_CONFIDENCE = 0.3
+MIN_LIFT = 1.0
+MAX_ITEMSET_LENGTH = 3
+MAX_RULES_PER_ANTECEDENT = 20
+
+# Số triệu chứng đầu vào tối đa được dùng để tra cứu (sau khi lọc theo chỉ mục)
+MAX_QUERY_SYMPTOMS = 20
+
+# Ký tự nối các triệu chứng trong khóa vế trái
+KEY_SEPARATOR = "|"
+
+
+def normalize_symptom(name):
+    """
+    Chuẩn hóa tên triệu chứng: bỏ khoảng trắng thừa và chuyển về chữ thường.
+    """
+    return " ".join(str(name).split()).lower()
+
+
+def antecedent_key(symptoms):
+    """
+    Tạo khóa chuẩn hóa (đã sắp xếp) cho một tập triệu chứng vế trái.
+    """
+    return KEY_SEPARATOR.join(sorted(symptoms))
+
+
+def load_transactions(data_dir="data"):
+    """
+    Đọc dữ liệu bệnh-triệu chứng từ các tệp JSON.
+    Mỗi bệnh là một giao dịch gồm tập tên triệu chứng (name_en, đã chuẩn hóa) của bệnh đó.
+    """
+    with open(os.path.join(data_dir, "table_symptom.json"), "r", encoding="utf-8") as f:
+        symptoms = json.load(f)
+    with open(os.path.join(data_dir, "table_disease_symptom.json"), "r", encoding="utf-8") as f:
+        relations = json.load(f)
+
+    symptom_names = {
+        s.get("symptom_id"): normalize_symptom(s.get("name_en")) for s in symptoms if s.get("name_en")
+    }
+
+    disease_symptoms = {}
+    for relation in relations:
+        name = symptom_names.get(relation.get("symptom_id"))
+        if name is None:
+            continue  # Bỏ qua nếu không tìm thấy triệu chứng
+        disease_symptoms.setdefault(relation.get("disease_id"), set()).add(name)
+
+    return list(disease_symptoms.values())
+
+
+def generate_rules(frequent_itemsets, num_transactions, min_confidence=MIN_CONFIDENCE, min_lift=MIN_LIFT):
+    """
+    Sinh luật kết hợp A -> c (vế phải là một triệu chứng) từ các tập phổ biến.
+    :param frequent_itemsets: Dictionary {frozenset: số lần xuất hiện} từ apriori.
+    :param num_transactions: Tổng số giao dịch.
+    :return: Danh sách luật (antecedent, consequent, support, confidence, lift).
+    """
+    rules = []
+    for itemset, count in frequent_itemsets.items():
+        if len(itemset) < 2:
+            continue
+        for consequent in itemset:
+            antecedent = itemset - {consequent}
+            antecedent_count = frequent_itemsets.get(antecedent)
+            consequent_count = frequent_itemsets.get(frozenset([consequent]))
+            if not antecedent_count or not consequent_count:
+                continue
+
+            confidence = count / antecedent_count
+            lift = confidence / (consequent_count / num_transactions)
+            if confidence < min_confidence or lift < min_lift:
+                continue
+
+            rules.append((antecedent, consequent, count / num_transactions, confidence, lift))
+    return rules
+
+
+def build_index(rules, max_rules_per_antecedent=MAX_RULES_PER_ANTECEDENT):
+    """
+    Gom các luật theo vế trái, mỗi vế trái giữ tối đa max_rules_per_antecedent luật
+    đã sắp xếp theo (confidence, lift) giảm dần.
+    Mỗi luật được lưu gọn dưới dạng [consequent, confidence, lift, support].
+    """
+    grouped = {}
+    for antecedent, consequent, support, confidence, lift in rules:
+        grouped.setdefault(antecedent_key(antecedent), []).append(
+            [consequent, round(confidence, 4), round(lift, 4), round(support, 6)]
+        )
+
+    index = {}
+    for key, entries in grouped.items():
+        entries.sort(key=lambda r: (r[1], r[2]), reverse=True)
+        index[key] = entries[:max_rules_per_antecedent]
+    return index
+
+
+def mine_rules_index(transactions, min_support=MIN_SUPPORT, min_confidence=MIN_CONFIDENCE,
+                     min_lift=MIN_LIFT, max_length=MAX_ITEMSET_LENGTH):
+    """
+    Khai phá tập phổ biến và luật kết hợp, trả về chỉ mục luật theo vế trái.
+    """
+    if not transactions:
+        raise ValueError("Danh sách giao dịch bị rỗng.")
+
+    frequent_itemsets = apriori(transactions, min_support, max_length=max_length)
+    rules = generate_rules(frequent_itemsets, len(transactions), min_confidence, min_lift)
+    logger.info(f"Tìm thấy {len(frequent_itemsets)} tập phổ biến và {len(rules)} luật kết hợp")
+
+    index = build_index(rules)
+    return {
+        "max_antecedent_length": max((len(s) for s in frequent_itemsets), default=1) - 1,
+        "num_transactions": len(transactions),
+        "symptoms": {symptom for transaction in transactions for symptom in transaction},
+        "antecedent_symptoms": antecedent_vocabulary(index),
+        "rules": index,
+    }
+
+
+def antecedent_vocabulary(rules):
+    """
+    Tập các triệu chứng xuất hiện trong vế trái của ít nhất một luật.
+    """
+    return {symptom for key in rules for symptom in key.split(KEY_SEPARATOR)}
+
+
+def save_index(index, path=RULES_INDEX_PATH):
+    """
+    Lưu chỉ mục luật kết hợp ra file JSON (các tập triệu chứng được lưu dưới dạng danh sách đã sắp xếp).
+    """
+    index = dict(
+        index,
+        symptoms=sorted(index["symptoms"]),
+        antecedent_symptoms=sorted(index["antecedent_symptoms"]),
+    )
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(index, f, ensure_ascii=False, separators=(",", ":"))
+
+
+def load_index(path=RULES_INDEX_PATH):
+    """
+    Đọc chỉ mục luật kết hợp. Trả về None nếu chưa có file chỉ mục.
+    """
+    if not os.path.exists(path):
+        logger.warning(f"Không tìm thấy chỉ mục luật kết hợp tại {path}")
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        index = json.load(f)
+
+    # Dùng set để tra cứu nhanh; chỉ mục cũ chưa lưu sẵn thì tính từ các luật
+    if "antecedent_symptoms" in index:
+        index["antecedent_symptoms"] = set(index["antecedent_symptoms"])
+    else:
+        index["antecedent_symptoms"] = antecedent_vocabulary(index["rules"])
+    if "symptoms" in index:
+        index["symptoms"] = set(index["symptoms"])
+    else:
+        index["symptoms"] = index["antecedent_symptoms"] | {
+            rule[0] for entries in index["rules"].values() for rule in entries
+        }
+    return index
+
+
+def suggest_related_symptoms(index, symptoms, top_k=5):
+    """
+    Đề xuất các triệu chứng nên hỏi thêm dựa trên tập triệu chứng đã biết.
+    Chỉ tra cứu chỉ mục đã tính sẵn, không khai phá dữ liệu khi xử lý yêu cầu.
+    :param index: Chỉ mục luật từ load_index().
+    :param symptoms: Danh sách triệu chứng đã biết (được chuẩn hóa trước khi tra cứu).
+        Chỉ MAX_QUERY_SYMPTOMS triệu chứng đầu tiên có trong vế trái của các luật được dùng để tra cứu.
+    :param top_k: Số triệu chứng đề xuất tối đa.
+    :return: Danh sách đề xuất sắp xếp theo confidence, lift giảm dần.
+    """
+    symptoms = [normalize_symptom(s) for s in symptoms]
+    known = set(symptoms)
+    rules = index["rules"]
+
+    # Chỉ giữ các triệu chứng có thể là vế trái để giới hạn số tổ hợp cần tra cứu
+    vocabulary = index["antecedent_symptoms"]
+    lookup = [s for s in dict.fromkeys(symptoms) if s in vocabulary][:MAX_QUERY_SYMPTOMS]
+    max_length = min(index["max_antecedent_length"], len(lookup))
+
+    best = {}
+    for length in range(1, max_length + 1):
+        for antecedent in combinations(sorted(lookup), length):
+            for consequent, confidence, lift, support in rules.get(KEY_SEPARATOR.join(antecedent), ()):
+                if consequent in known:
+                    continue
+                current = best.get(consequent)
+                if current is None or (confidence, lift) > (current["confidence"], current["lift"]):
+                    best[consequent] = {
+                        "symptom": consequent,
+                        "because_of": list(antecedent),
+                        "confidence": confidence,
+                        "lift": lift,
+                        "support": support,
+                    }
+
+    return sorted(best.values(), key=lambda r: (r["confidence"], r["lift"]), reverse=True)[:top_k]
+
+
+def main():
+    # Đọc dữ liệu bệnh-triệu chứng
+    transactions = load_transactions()
+
+    # Khai phá luật và lưu chỉ mục
+    index = mine_rules_index(transactions)
+    save_index(index)
+
+    print(f"Đã lưu {sum(len(r) for r in index['rules'].values())} luật "
+          f"cho {len(index['rules'])} vế trái vào {RULES_INDEX_PATH}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,6 @@
 import csv
 from itertools import combinations
+from math import comb
 
 def load_data(file_path):
     """
@@ -15,17 +16,35 @@ def load_data(file_path):
 
 def generate_candidates(itemsets, length):
     """
-    Generate candidate itemsets of a given length.
+    Generate candidate itemsets of a given length by joining frequent itemsets
+    of length - 1. Candidates with an infrequent subset are pruned.
     """
-    return set([frozenset(comb) for itemset in itemsets for comb in combinations(itemset, length)])
+    itemsets = set(itemsets)
+    candidates = set()
+    for a, b in combinations(itemsets, 2):
+        union = a | b
+        if len(union) != length or union in candidates:
+            continue
+        if all(frozenset(subset) in itemsets for subset in combinations(union, length - 1)):
+            candidates.add(union)
+    return candidates
 
 def filter_candidates(transactions, candidates, min_support):
     """
     Filter candidates based on minimum support.
     """
     itemset_counts = {candidate: 0 for candidate in candidates}
+    lengths = {len(candidate) for candidate in itemset_counts}
+    length = lengths.pop() if len(lengths) == 1 else None
     for transaction in transactions:
-        for candidate in candidates:
+        # For sparse data, enumerating the transaction's subsets is cheaper than scanning all candidates
+        if length is not None and comb(len(transaction), length) < len(itemset_counts):
+            for subset in combinations(transaction, length):
+                subset = frozenset(subset)
+                if subset in itemset_counts:
+                    itemset_counts[subset] += 1
+            continue
+        for candidate in itemset_counts:
             if candidate.issubset(transaction):
                 itemset_counts[candidate] += 1
 
@@ -34,9 +53,10 @@ def filter_candidates(transactions, candidates, min_support):
     frequent_itemsets = {itemset: count for itemset, count in itemset_counts.items() if count / num_transactions >= min_support}
     return frequent_itemsets
 
-def apriori(transactions, min_support):
+def apriori(transactions, min_support, max_length=None):
     """
     Apriori algorithm to find frequent itemsets.
+    If max_length is given, itemsets longer than max_length are not generated.
     """
     # Step 1: Generate frequent 1-itemsets
     items = set(item for transaction in transactions for item in transaction)
@@ -47,7 +67,7 @@ def apriori(transactions, min_support):
     k = 2
 
     # Step 2: Generate frequent k-itemsets
-    while frequent_itemsets:
+    while frequent_itemsets and (max_length is None or k <= max_length):
         candidates = generate_candidates(frequent_itemsets.keys(), k)
         frequent_itemsets = filter_candidates(transactions, candidates, min_support)
         all_frequent_itemsets.update(frequent_itemsets)
@@ -4,6 +4,7 @@ import json
 from dotenv import load_dotenv
 import logging
 import time
+from llm_limiter import gemini_limiter, LimiterRejected, PRIORITY_DIAGNOSIS, PRIORITY_EXTERNAL
 
 # Thiết lập logging
 logging.basicConfig(level=logging.INFO)
@@ -20,46 +21,26 @@ API_URL = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-fl
 API_KEY = os.getenv("GEMINI_API_KEY")
 logger.info(f"API Key loaded: {'✓' if API_KEY else '✗'}")
 
-def query_gemini_api_for_diagnosis(symptoms, top_diseases, mapped_symptoms):
-    """
-    Gửi triệu chứng và danh sách bệnh ưu tiên đến Gemini để nhận chẩn đoán y khoa.
-    :param symptoms: Danh sách triệu chứng gốc của bệnh nhân.
-    :param top_diseases: Danh sách bệnh ưu tiên cao từ cơ sở dữ liệu (đã kèm thông tin chi tiết).
-    :param mapped_symptoms: Danh sách các triệu chứng đã được map với cơ sở dữ liệu.
-    :return: Kết quả chẩn đoán từ API.
-    """
-    if not API_KEY:
-        raise Exception("API Key không được tìm thấy. Vui lòng kiểm tra file .env.")
+# Thời gian chờ tối đa cho mỗi lời gọi API (giây), tránh giữ lượt gọi quá lâu
+REQUEST_TIMEOUT = float(os.getenv("GEMINI_REQUEST_TIMEOUT", "60"))
 
-    symptoms_str = ", ".join(symptoms)
-    
-    # Kiểm tra độ khớp của bệnh có thấp không
-    best_match_percentage = top_diseases[0]["match_percentage"] if top_diseases else 0
-    low_match_quality = best_match_percentage < 50
-    
-    # Tạo thông tin chi tiết về các bệnh để Gemini phân tích
-    diseases_details = ""
-    for i, disease in enumerate(top_diseases):
-        diseases_details += f"\n{i+1}. {disease['name_en']} ({disease['match_percentage']}% khớp):\n"
-        diseases_details += f"   - Triệu chứng khớp ({disease['matching_symptoms_count']}/{disease['total_symptoms_count']}): {', '.join(disease['matching_symptoms'])}\n"
-        if disease['description'] and disease['description'] != "Không có mô tả chi tiết":
-            # Rút gọn mô tả nếu quá dài
-            description = disease['description']
-            if len(description) > 500:
-                description = description[:500] + "..."
-            diseases_details += f"   - Mô tả: {description}\n"
-    
-    # Điều chỉnh prompt dựa vào độ khớp
-    match_quality_text = ""
-    if low_match_quality:
-        match_quality_text = "\nLƯU Ý QUAN TRỌNG: Các bệnh trong danh sách có độ khớp thấp với các triệu chứng được cung cấp (<50%). Hãy đưa ra một số lý do tại sao và nhấn mạnh sự cần thiết phải tham khảo ý kiến bác sĩ trực tiếp."
-    
-    prompt = f"""
+# Giới hạn số token đầu vào của prompt chẩn đoán
+PROMPT_TOKEN_BUDGET = int(os.getenv("GEMINI_PROMPT_TOKEN_BUDGET", "1500"))
+# Ước lượng thô số ký tự cho mỗi token (thận trọng với tiếng Việt có dấu)
+CHARS_PER_TOKEN = 3
+# Độ dài tối đa của mô tả bệnh trong prompt
+MAX_DESCRIPTION_LENGTH = 500
+NO_DESCRIPTION = "Không có mô tả chi tiết"
+
+# Các phần cố định của prompt chẩn đoán, chỉ tạo một lần
+_DIAGNOSIS_PROMPT_HEADER = """
 Hãy đóng vai một bác sĩ đa khoa giàu kinh nghiệm đang chẩn đoán bệnh cho bệnh nhân. Dựa trên thông tin sau:
 
-TRIỆU CHỨNG BÁO CÁO: {symptoms_str}
+TRIỆU CHỨNG BÁO CÁO: {symptoms}
 
-CÁC BỆNH PHÙ HỢP NHẤT TỪ CƠ SỞ DỮ LIỆU Y KHOA: {diseases_details}{match_quality_text}
+CÁC BỆNH PHÙ HỢP NHẤT TỪ CƠ SỞ DỮ LIỆU Y KHOA: """
+
+_DIAGNOSIS_PROMPT_FOOTER = """{match_quality_text}
 
 Hãy phân tích và đưa ra:
 1. CHẨN ĐOÁN CHÍNH: Phân tích 2-3 bệnh có khả năng cao nhất từ danh sách trên, giải thích tại sao triệu chứng phù hợp với từng bệnh
@@ -70,9 +51,175 @@ LƯU Ý QUAN TRỌNG:
 - Chỉ phân tích các bệnh từ danh sách đã cung cấp, không đưa ra bệnh khác ngoài danh sách
 - Tập trung vào bệnh có tỷ lệ khớp cao nhất và số lượng triệu chứng khớp nhiều nhất
 - Trả lời như một bác sĩ chuyên nghiệp, ngắn gọn và chính xác
-- {"Nhấn mạnh rằng nên đến gặp bác sĩ để thăm khám trực tiếp do độ khớp với các bệnh thấp" if low_match_quality else ""}
+- {low_match_note}
 """
 
+# Phần cuối prompt theo độ khớp (True: độ khớp thấp)
+_DIAGNOSIS_PROMPT_FOOTERS = {
+    False: _DIAGNOSIS_PROMPT_FOOTER.format(match_quality_text="", low_match_note=""),
+    True: _DIAGNOSIS_PROMPT_FOOTER.format(
+        match_quality_text="\nLƯU Ý QUAN TRỌNG: Các bệnh trong danh sách có độ khớp thấp với các triệu chứng được cung cấp (<50%). Hãy đưa ra một số lý do tại sao và nhấn mạnh sự cần thiết phải tham khảo ý kiến bác sĩ trực tiếp.",
+        low_match_note="Nhấn mạnh rằng nên đến gặp bác sĩ để thăm khám trực tiếp do độ khớp với các bệnh thấp"
+    ),
+}
+
+# Bộ nhớ đệm các đoạn prompt theo từng bệnh: disease_id -> fragment
+_disease_fragments = {}
+
+
+def estimate_tokens(text):
+    """
+    Ước lượng số token của một đoạn văn bản.
+    """
+    return -(-len(text) // CHARS_PER_TOKEN)
+
+
+def truncate_list(items, max_tokens):
+    """
+    Nối danh sách bằng ", " sao cho không vượt quá max_tokens,
+    các mục bị bỏ được thay bằng ghi chú "... (+N)".
+    :return: (chuỗi kết quả, số mục bị bỏ)
+    """
+    text = ", ".join(items)
+    if estimate_tokens(text) <= max_tokens:
+        return text, 0
+
+    max_chars = max_tokens * CHARS_PER_TOKEN - len(f", ... (+{len(items)})")
+    kept = []
+    used_chars = 0
+    for item in items:
+        added = len(item) + (2 if kept else 0)
+        if used_chars + added > max_chars:
+            break
+        kept.append(item)
+        used_chars += added
+
+    omitted = len(items) - len(kept)
+    return (", ".join(kept) + ", " if kept else "") + f"... (+{omitted})", omitted
+
+
+def build_disease_fragment(name, description):
+    """
+    Tạo đoạn prompt cố định của một bệnh: tên đã chuẩn hóa và dòng mô tả đã rút gọn.
+    """
+    description_line = ""
+    if description and description != NO_DESCRIPTION:
+        # Rút gọn mô tả nếu quá dài
+        if len(description) > MAX_DESCRIPTION_LENGTH:
+            description = description[:MAX_DESCRIPTION_LENGTH] + "..."
+        description_line = f"   - Mô tả: {description}\n"
+
+    return {
+        "name": " ".join((name or "").split()),
+        "description_line": description_line,
+        "description_tokens": estimate_tokens(description_line),
+    }
+
+
+def refresh_prompt_fragments(diseases):
+    """
+    Tạo lại toàn bộ bộ nhớ đệm đoạn prompt khi cơ sở tri thức được nạp lại.
+    :param diseases: Danh sách bản ghi có disease_id, name_en, des_en.
+    """
+    global _disease_fragments
+    _disease_fragments = {
+        d.disease_id: build_disease_fragment(d.name_en, d.des_en) for d in diseases
+    }
+    logger.info(f"Đã tạo sẵn đoạn prompt cho {len(_disease_fragments)} bệnh")
+
+
+def get_disease_fragment(disease):
+    """
+    Lấy đoạn prompt của một bệnh từ bộ nhớ đệm, tạo mới nếu chưa có.
+    """
+    fragment = _disease_fragments.get(disease["disease_id"])
+    if fragment is None:
+        fragment = build_disease_fragment(disease["name_en"], disease["description"])
+        _disease_fragments[disease["disease_id"]] = fragment
+    return fragment
+
+
+def _disease_summary(i, fragment, disease, matching_str):
+    """
+    Tạo dòng tóm tắt của bệnh thứ i + 1 với danh sách triệu chứng khớp đã nối sẵn.
+    """
+    return (
+        f"\n{i+1}. {fragment['name']} ({disease['match_percentage']}% khớp):\n"
+        f"   - Triệu chứng khớp ({disease['matching_symptoms_count']}/{disease['total_symptoms_count']}): {matching_str}\n"
+    )
+
+
+def build_diagnosis_prompt(symptoms, top_diseases, token_budget=PROMPT_TOKEN_BUDGET):
+    """
+    Tạo prompt chẩn đoán với số token không vượt quá token_budget.
+    Danh sách triệu chứng đầu vào chiếm tối đa một nửa phần token còn lại sau các phần cố định.
+    Khi vượt giới hạn, các bệnh có thứ hạng thấp bị bỏ trước (mỗi bệnh bỏ mô tả
+    trước rồi mới bỏ hẳn); bệnh có thứ hạng cao nhất luôn được giữ lại,
+    danh sách triệu chứng khớp của nó được rút gọn nếu cần.
+    :param symptoms: Danh sách triệu chứng gốc của bệnh nhân.
+    :param top_diseases: Danh sách bệnh đã sắp xếp theo độ phù hợp giảm dần.
+    :param token_budget: Số token tối đa ước lượng cho prompt.
+    :return: Nội dung prompt.
+    """
+    # Kiểm tra độ khớp của bệnh có thấp không
+    best_match_percentage = top_diseases[0]["match_percentage"] if top_diseases else 0
+    low_match_quality = best_match_percentage < 50
+
+    footer = _DIAGNOSIS_PROMPT_FOOTERS[low_match_quality]
+    fixed_tokens = estimate_tokens(_DIAGNOSIS_PROMPT_HEADER.format(symptoms="")) + estimate_tokens(footer)
+    if fixed_tokens > token_budget:
+        logger.warning(f"Phần cố định của prompt ({fixed_tokens} token) đã vượt giới hạn {token_budget} token")
+
+    # Rút gọn danh sách triệu chứng đầu vào
+    symptoms_str, omitted = truncate_list(symptoms, max(token_budget - fixed_tokens, 0) // 2)
+    if omitted:
+        logger.info(f"Prompt vượt giới hạn {token_budget} token, bỏ {omitted} triệu chứng đầu vào")
+    header = _DIAGNOSIS_PROMPT_HEADER.format(symptoms=symptoms_str)
+    used_tokens = estimate_tokens(header) + estimate_tokens(footer)
+
+    # Tạo thông tin chi tiết về các bệnh theo thứ tự ưu tiên
+    parts = []
+    for i, disease in enumerate(top_diseases):
+        fragment = get_disease_fragment(disease)
+        summary = _disease_summary(i, fragment, disease, ", ".join(disease['matching_symptoms']))
+        summary_tokens = estimate_tokens(summary)
+        if used_tokens + summary_tokens > token_budget:
+            if parts:
+                logger.info(f"Prompt vượt giới hạn {token_budget} token, bỏ {len(top_diseases) - i} bệnh có thứ hạng thấp")
+                break
+
+            # Bệnh có thứ hạng cao nhất luôn được giữ, chỉ rút gọn danh sách triệu chứng khớp
+            list_budget = token_budget - used_tokens - estimate_tokens(_disease_summary(i, fragment, disease, ""))
+            matching, omitted = truncate_list(disease['matching_symptoms'], max(list_budget, 0))
+            logger.info(f"Prompt vượt giới hạn {token_budget} token, bỏ {omitted} triệu chứng khớp của bệnh thứ 1")
+            summary = _disease_summary(i, fragment, disease, matching)
+            summary_tokens = estimate_tokens(summary)
+
+        parts.append(summary)
+        used_tokens += summary_tokens
+
+        if fragment["description_line"]:
+            if used_tokens + fragment["description_tokens"] > token_budget:
+                logger.info(f"Prompt vượt giới hạn {token_budget} token, bỏ mô tả bệnh thứ {i+1} và các bệnh sau")
+                break
+            parts.append(fragment["description_line"])
+            used_tokens += fragment["description_tokens"]
+
+    return header + "".join(parts) + footer
+
+def query_gemini_api_for_diagnosis(symptoms, top_diseases, mapped_symptoms):
+    """
+    Gửi triệu chứng và danh sách bệnh ưu tiên đến Gemini để nhận chẩn đoán y khoa.
+    :param symptoms: Danh sách triệu chứng gốc của bệnh nhân.
+    :param top_diseases: Danh sách bệnh ưu tiên cao từ cơ sở dữ liệu (đã kèm thông tin chi tiết).
+    :param mapped_symptoms: Danh sách các triệu chứng đã được map với cơ sở dữ liệu.
+    :return: Kết quả chẩn đoán từ API.
+    """
+    if not API_KEY:
+        raise Exception("API Key không được tìm thấy. Vui lòng kiểm tra file .env.")
+
+    prompt = build_diagnosis_prompt(symptoms, top_diseases)
+
     headers = {"Content-Type": "application/json"}
     payload = {
         "contents": [
@@ -84,7 +231,8 @@ LƯU Ý QUAN TRỌNG:
 
     try:
         logger.info(f"Gửi yêu cầu đến Gemini API với {len(symptoms)} triệu chứng")
-        response = requests.post(f"{API_URL}?key={API_KEY}", json=payload, headers=headers)
+        with gemini_limiter.slot(PRIORITY_DIAGNOSIS):
+            response = requests.post(f"{API_URL}?key={API_KEY}", json=payload, headers=headers, timeout=REQUEST_TIMEOUT)
         response.raise_for_status()
         result = response.json()
         logger.info("Nhận phản hồi thành công từ Gemini API")
@@ -100,14 +248,21 @@ LƯU Ý QUAN TRỌNG:
         return {
             "medical_analysis": "Không thể tạo phân tích y khoa do lỗi kết nối với API. Vui lòng thử lại sau."
         }
+    except LimiterRejected as e:
+        logger.error(f"Không thể gọi Gemini API do quá tải: {str(e)}")
+        return {
+            "medical_analysis": "Không thể tạo phân tích y khoa do hệ thống đang quá tải. Vui lòng thử lại sau."
+        }
 
-def search_disease_external(symptoms=None, disease_name=None):
+def search_disease_external(symptoms=None, disease_name=None, priority=PRIORITY_EXTERNAL):
     """
     Tìm kiếm thông tin bệnh từ nguồn bên ngoài khi không có trong database hoặc độ khớp thấp.
     
     :param symptoms: Danh sách triệu chứng (nếu tìm theo triệu chứng)
     :param disease_name: Tên bệnh (nếu tìm theo tên bệnh)
+    :param priority: Mức ưu tiên khi xếp hàng gọi API; mặc định là tìm kiếm bổ sung, bị cắt tải trước khi quá tải
     :return: Thông tin bệnh từ nguồn bên ngoài
+    :raises LimiterRejected: khi yêu cầu bị bộ giới hạn từ chối
     """
     if not API_KEY:
         raise Exception("API Key không được tìm thấy. Vui lòng kiểm tra file .env.")
@@ -155,7 +310,8 @@ QUAN TRỌNG: Hãy cung cấp ít nhất hai nguồn tham khảo y khoa đáng t
     
     try:
         logger.info(f"Tìm kiếm thông tin y tế bổ sung từ nguồn bên ngoài")
-        response = requests.post(f"{API_URL}?key={API_KEY}", json=payload, headers=headers)
+        with gemini_limiter.slot(priority):
+            response = requests.post(f"{API_URL}?key={API_KEY}", json=payload, headers=headers, timeout=REQUEST_TIMEOUT)
         response.raise_for_status()
         result = response.json()
         
@@ -0,0 +1,235 @@
+import heapq
+import itertools
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Thiết lập logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Mức ưu tiên (số nhỏ hơn được phục vụ trước)
+PRIORITY_DIAGNOSIS = 0
+PRIORITY_EXTERNAL = 1
+
+PRIORITY_NAMES = {
+    PRIORITY_DIAGNOSIS: "diagnosis",
+    PRIORITY_EXTERNAL: "external_search",
+}
+
+# Số luồng của threadpool xử lý các endpoint đồng bộ (Starlette mặc định là 40)
+THREADPOOL_SIZE = int(os.getenv("THREADPOOL_SIZE", "40"))
+
+
+class LimiterRejected(Exception):
+    """
+    Yêu cầu bị từ chối bởi bộ giới hạn (hàng đợi đầy, bị cắt tải hoặc chờ quá lâu).
+    """
+    def __init__(self, reason, message):
+        super().__init__(message)
+        self.reason = reason
+
+
+class TokenBucket:
+    """
+    Token bucket giới hạn tốc độ gọi API theo hạn mức (số yêu cầu mỗi phút).
+    Không tự khóa, cần được gọi bên trong khóa của GeminiLimiter.
+    """
+    def __init__(self, rate_per_minute, burst):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = float(burst)
+        self.tokens = float(burst)
+        self.updated_at = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def try_take(self):
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def seconds_until_available(self):
+        self._refill()
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class GeminiLimiter:
+    """
+    Giới hạn số lời gọi Gemini đồng thời trong toàn tiến trình.
+    - Tối đa max_concurrent lời gọi đang chạy, các yêu cầu còn lại xếp hàng theo mức ưu tiên.
+    - Hàng đợi có giới hạn max_queue. Khi đầy, yêu cầu chẩn đoán đẩy yêu cầu tìm kiếm bên ngoài
+      xếp sau cùng ra khỏi hàng đợi; nếu không có thì bị từ chối.
+    - Yêu cầu có mức ưu tiên thấp (tìm kiếm bên ngoài) bị cắt tải khi hàng đợi dài hơn shed_queue_depth,
+      kể cả khi đã đang chờ.
+    - Token bucket giữ tốc độ gọi trong hạn mức API.
+    Mỗi yêu cầu chờ chiếm một luồng của threadpool, nên khi có max_threads thì
+    max_concurrent + max_queue không được vượt quá một nửa số luồng đó.
+    """
+    def __init__(self, max_concurrent, max_queue, rate_per_minute, burst, shed_queue_depth, queue_timeout,
+                 max_threads=None):
+        if max_concurrent < 1:
+            raise ValueError("max_concurrent phải lớn hơn hoặc bằng 1")
+        if max_queue < 1:
+            raise ValueError("max_queue phải lớn hơn hoặc bằng 1")
+        if rate_per_minute <= 0:
+            raise ValueError("rate_per_minute phải lớn hơn 0")
+        if burst < 1:
+            raise ValueError("burst phải lớn hơn hoặc bằng 1")
+        if max_threads is not None and max_concurrent + max_queue > max_threads // 2:
+            raise ValueError(
+                f"max_concurrent + max_queue ({max_concurrent + max_queue}) vượt quá một nửa "
+                f"số luồng của threadpool ({max_threads})"
+            )
+
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.shed_queue_depth = shed_queue_depth
+        self.queue_timeout = queue_timeout
+        self.bucket = TokenBucket(rate_per_minute, burst)
+
+        self._condition = threading.Condition()
+        self._waiters = []  # heap (priority, seq)
+        self._evicted = set()  # các yêu cầu bị đẩy ra khỏi hàng đợi, chờ luồng của chúng xử lý
+        self._sequence = itertools.count()
+        self._in_flight = 0
+
+        # Số liệu thống kê
+        self._peak_queue_depth = 0
+        self._admitted = {name: 0 for name in PRIORITY_NAMES.values()}
+        self._rejected = {}
+        self._wait_count = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    def _reject(self, priority, reason, message):
+        key = f"{PRIORITY_NAMES.get(priority, priority)}:{reason}"
+        self._rejected[key] = self._rejected.get(key, 0) + 1
+        logger.warning(f"Từ chối lời gọi Gemini ({key}): {message}")
+        raise LimiterRejected(reason, message)
+
+    def _record_wait(self, priority, waited):
+        name = PRIORITY_NAMES.get(priority, priority)
+        self._admitted[name] = self._admitted.get(name, 0) + 1
+        self._wait_count += 1
+        self._wait_total += waited
+        self._wait_max = max(self._wait_max, waited)
+
+    def _evict_external(self):
+        """
+        Đẩy yêu cầu tìm kiếm bên ngoài xếp sau cùng ra khỏi hàng đợi.
+        :return: True nếu có yêu cầu bị đẩy ra.
+        """
+        candidates = [entry for entry in self._waiters if entry[0] > PRIORITY_DIAGNOSIS]
+        if not candidates:
+            return False
+        victim = max(candidates)
+        self._waiters.remove(victim)
+        heapq.heapify(self._waiters)
+        self._evicted.add(victim)
+        self._condition.notify_all()
+        return True
+
+    def _acquire(self, priority, timeout):
+        with self._condition:
+            queue_depth = len(self._waiters)
+            if priority > PRIORITY_DIAGNOSIS and queue_depth >= self.shed_queue_depth:
+                self._reject(priority, "shed", "Hệ thống đang quá tải, bỏ qua yêu cầu không bắt buộc")
+            if queue_depth >= self.max_queue:
+                if priority > PRIORITY_DIAGNOSIS or not self._evict_external():
+                    self._reject(priority, "queue_full", "Hàng đợi gọi Gemini đã đầy")
+
+            entry = (priority, next(self._sequence))
+            heapq.heappush(self._waiters, entry)
+            self._peak_queue_depth = max(self._peak_queue_depth, len(self._waiters))
+            if len(self._waiters) > self.shed_queue_depth:
+                # Để các yêu cầu tìm kiếm bên ngoài đang chờ kiểm tra lại ngưỡng cắt tải
+                self._condition.notify_all()
+
+            started_at = time.monotonic()
+            deadline = started_at + timeout
+            try:
+                while True:
+                    if entry in self._evicted:
+                        self._reject(priority, "shed", "Nhường chỗ cho yêu cầu chẩn đoán do hàng đợi đầy")
+                    if priority > PRIORITY_DIAGNOSIS and len(self._waiters) - 1 >= self.shed_queue_depth:
+                        self._reject(priority, "shed", "Hệ thống đang quá tải, bỏ qua yêu cầu không bắt buộc")
+
+                    if self._waiters[0] == entry and self._in_flight < self.max_concurrent:
+                        if self.bucket.try_take():
+                            break
+                        wait = self.bucket.seconds_until_available()
+                    else:
+                        wait = None
+
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._reject(priority, "timeout", "Chờ gọi Gemini quá lâu")
+                    self._condition.wait(remaining if wait is None else min(wait, remaining))
+            finally:
+                if entry in self._evicted:
+                    self._evicted.discard(entry)
+                else:
+                    self._waiters.remove(entry)
+                    heapq.heapify(self._waiters)
+                # Đánh thức yêu cầu kế tiếp ở đầu hàng đợi
+                self._condition.notify_all()
+
+            self._in_flight += 1
+            self._record_wait(priority, time.monotonic() - started_at)
+
+    def _release(self):
+        with self._condition:
+            self._in_flight -= 1
+            self._condition.notify_all()
+
+    @contextmanager
+    def slot(self, priority=PRIORITY_DIAGNOSIS, timeout=None):
+        """
+        Chiếm một lượt gọi Gemini trong khối with.
+        :raises LimiterRejected: khi yêu cầu bị từ chối hoặc chờ quá thời gian.
+        """
+        self._acquire(priority, self.queue_timeout if timeout is None else timeout)
+        try:
+            yield
+        finally:
+            self._release()
+
+    def metrics(self):
+        with self._condition:
+            self.bucket._refill()
+            return {
+                "in_flight": self._in_flight,
+                "max_concurrent": self.max_concurrent,
+                "queue_depth": len(self._waiters),
+                "peak_queue_depth": self._peak_queue_depth,
+                "max_queue": self.max_queue,
+                "available_tokens": round(self.bucket.tokens, 2),
+                "admitted": dict(self._admitted),
+                "rejected": dict(self._rejected),
+                "wait_time_seconds": {
+                    "count": self._wait_count,
+                    "avg": round(self._wait_total / self._wait_count, 4) if self._wait_count else 0.0,
+                    "max": round(self._wait_max, 4),
+                },
+            }
+
+
+# Bộ giới hạn dùng chung cho toàn tiến trình, cấu hình từ biến môi trường
+gemini_limiter = GeminiLimiter(
+    max_concurrent=int(os.getenv("GEMINI_MAX_CONCURRENT", "4")),
+    max_queue=int(os.getenv("GEMINI_MAX_QUEUE", "12")),
+    rate_per_minute=float(os.getenv("GEMINI_RATE_PER_MINUTE", "15")),
+    burst=int(os.getenv("GEMINI_RATE_BURST", "4")),
+    shed_queue_depth=int(os.getenv("GEMINI_SHED_QUEUE_DEPTH", "8")),
+    queue_timeout=float(os.getenv("GEMINI_QUEUE_TIMEOUT", "30")),
+    max_threads=THREADPOOL_SIZE,
+)
@@ -1,9 +1,13 @@
 from fastapi import FastAPI, HTTPException, Depends
-from pydantic import BaseModel
+from anyio import to_thread
+from pydantic import BaseModel, Field
+from typing import List
 from sqlalchemy.orm import Session
 from sqlalchemy import func, or_
 from database import SessionLocal, Symptom, Disease, DiseaseSymptom
-from gemini_api import query_gemini_api_for_diagnosis, search_disease_external
+from gemini_api import query_gemini_api_for_diagnosis, search_disease_external, refresh_prompt_fragments
+from llm_limiter import gemini_limiter, LimiterRejected, PRIORITY_DIAGNOSIS, THREADPOOL_SIZE
+from association_rules import load_index, suggest_related_symptoms, normalize_symptom
 import logging
 from difflib import get_close_matches
 from collections import Counter
@@ -14,6 +18,39 @@ logger = logging.getLogger(__name__)
 
 app = FastAPI()
 
+@app.on_event("startup")
+async def configure_threadpool():
+    """
+    Cố định số luồng của threadpool cho các endpoint đồng bộ. Hàng đợi gọi Gemini
+    được giới hạn theo số luồng này để các yêu cầu chỉ dùng database không bị chặn.
+    """
+    to_thread.current_default_thread_limiter().total_tokens = THREADPOOL_SIZE
+
+# Chỉ mục luật kết hợp triệu chứng (tạo offline bằng association_rules.py)
+rules_index = None
+
+@app.on_event("startup")
+def load_knowledge_base():
+    """
+    Nạp các dữ liệu tính sẵn từ cơ sở tri thức: chỉ mục luật kết hợp
+    và các đoạn prompt theo từng bệnh cho Gemini.
+    """
+    global rules_index
+    try:
+        rules_index = load_index()
+    except Exception as e:
+        # Chỉ mục lỗi chỉ làm /related-symptoms trả về 503, không chặn khởi động ứng dụng
+        logger.error(f"Lỗi khi nạp chỉ mục luật kết hợp: {str(e)}")
+        rules_index = None
+
+    db = SessionLocal()
+    try:
+        refresh_prompt_fragments(db.query(Disease.disease_id, Disease.name_en, Disease.des_en).all())
+    except Exception as e:
+        logger.error(f"Lỗi khi tạo sẵn đoạn prompt: {str(e)}")
+    finally:
+        db.close()
+
 # Dependency: Kết nối cơ sở dữ liệu
 def get_db():
     db = SessionLocal()
@@ -25,6 +62,13 @@ def get_db():
 class SymptomRequest(BaseModel):
     symptoms: list
 
+class RelatedSymptomRequest(BaseModel):
+    symptoms: List[str]
+    top_k: int = Field(5, ge=1)
+
+# Số triệu chứng đầu vào tối đa cho một yêu cầu gợi ý triệu chứng liên quan
+MAX_RELATED_INPUT_SYMPTOMS = 50
+
 def find_similar_symptoms(input_symptoms, db_symptoms, threshold=0.6):
     """
     Tìm triệu chứng tương tự trong cơ sở dữ liệu sử dụng fuzzy matching
@@ -111,7 +155,8 @@ def predict_disease(request: SymptomRequest, db: Session = Depends(get_db)):
         
         if len(symptom_ids) == 0:
             # Nếu không tìm thấy triệu chứng nào trong database, tìm kiếm bên ngoài
-            external_result = search_disease_external(request.symptoms)
+            # Đây là phân tích duy nhất nên được ưu tiên như chẩn đoán
+            external_result = search_disease_external(request.symptoms, priority=PRIORITY_DIAGNOSIS)
             
             return {
                 "message": "Không tìm thấy triệu chứng nào trong cơ sở dữ liệu.",
@@ -151,7 +196,8 @@ def predict_disease(request: SymptomRequest, db: Session = Depends(get_db)):
         # Nếu không có bệnh nào phù hợp
         if not disease_matching_counts:
             # Nếu không tìm thấy bệnh nào trong database, tìm kiếm bên ngoài
-            external_result = search_disease_external(request.symptoms)
+            # Đây là phân tích duy nhất nên được ưu tiên như chẩn đoán
+            external_result = search_disease_external(request.symptoms, priority=PRIORITY_DIAGNOSIS)
             
             return {
                 "message": "Không tìm thấy bệnh nào liên quan đến các triệu chứng trong cơ sở dữ liệu.",
@@ -259,6 +305,12 @@ def predict_disease(request: SymptomRequest, db: Session = Depends(get_db)):
                     "source": external_result["source"],
                     "disclaimer": "Thông tin bổ sung này được lấy từ nguồn bên ngoài do kết quả từ cơ sở dữ liệu có độ khớp thấp."
                 }
+            except LimiterRejected as e:
+                logger.warning(f"Bỏ qua tìm kiếm bên ngoài: {str(e)}")
+                external_analysis = {
+                    "message": "Bỏ qua tìm kiếm thông tin bổ sung do hệ thống đang quá tải",
+                    "error": str(e)
+                }
             except Exception as e:
                 logger.error(f"Lỗi khi tìm kiếm bên ngoài: {str(e)}")
                 external_analysis = {
@@ -292,6 +344,48 @@ def predict_disease(request: SymptomRequest, db: Session = Depends(get_db)):
         
         return result
     
+    except LimiterRejected as e:
+        logger.error(f"Quá tải: {str(e)}")
+        raise HTTPException(status_code=503, detail=str(e))
     except Exception as e:
         logger.error(f"Lỗi: {str(e)}")
-        raise HTTPException(status_code=500, detail=str(e))
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/related-symptoms")
+def related_symptoms(request: RelatedSymptomRequest):
+    """
+    Đề xuất các triệu chứng nên hỏi thêm dựa trên các triệu chứng đã có,
+    tra cứu từ chỉ mục luật kết hợp đã tính sẵn.
+    """
+    if rules_index is None:
+        raise HTTPException(status_code=503, detail="Chỉ mục luật kết hợp chưa được tạo. Hãy chạy association_rules.py.")
+    if len(request.symptoms) > MAX_RELATED_INPUT_SYMPTOMS:
+        raise HTTPException(status_code=400, detail=f"Tối đa {MAX_RELATED_INPUT_SYMPTOMS} triệu chứng cho mỗi yêu cầu.")
+
+    # Map triệu chứng đầu vào với các triệu chứng trong chỉ mục như /predict
+    normalized = {s: normalize_symptom(s) for s in request.symptoms}
+    symptom_mapping = find_similar_symptoms(
+        list(dict.fromkeys(normalized.values())),
+        [(s,) for s in rules_index["symptoms"]]
+    )
+    symptom_not_found = [s for s in request.symptoms if normalized[s] not in symptom_mapping]
+    mapped_symptoms = list(dict.fromkeys(symptom_mapping.values()))
+
+    suggestions = suggest_related_symptoms(rules_index, mapped_symptoms, request.top_k)
+    return {
+        "symptoms_info": {
+            "input_symptoms": request.symptoms,
+            "found_in_database": [s for s in request.symptoms if s not in symptom_not_found],
+            "not_found_in_database": symptom_not_found
+        },
+        "mapped_symptoms": mapped_symptoms,
+        "related_symptoms": suggestions
+    }
+
+@app.get("/metrics/llm")
+def llm_metrics():
+    """
+    Số liệu của bộ giới hạn lời gọi Gemini: số lời gọi đang chạy, độ dài hàng đợi,
+    thời gian chờ và số yêu cầu bị từ chối.
+    """
+    return gemini_limiter.metrics()